@@ -42,6 +42,8 @@ void cfunc_filter::free() {
     cufftDestroy(plan_filter_fwd);
     cufftDestroy(plan_filter_inv);
     cudaFree(ge);
+    if (gpad != NULL)
+      cudaFree(gpad);
     is_free = true;   
   }
 }
@@ -60,3 +62,24 @@ void cfunc_filter::filter(size_t g_, size_t w_, size_t stream_) {
     cufftXtExec(plan_filter_inv, ge, g, CUFFT_INVERSE);
     mulrec <<<GS3d1, dimBlock, 0, stream>>> (g, 1/(float)n, n, nproj, nz);    
 }
+
+void cfunc_filter::filter_pad(size_t g_, size_t w_, size_t n0, size_t stream_) {
+    // filter projections of width n0 <= n, padding them to n with edge values on the fly,
+    // the result is written back to g
+    real* g = (real *)g_;
+    real2* w = (real2 *)w_;
+    cudaStream_t stream = (cudaStream_t)stream_;
+    if (gpad == NULL)
+      cudaMalloc((void **)&gpad, n * nproj * nz * sizeof(real));
+    cufftSetStream(plan_filter_fwd, stream);
+    cufftSetStream(plan_filter_inv, stream);
+    dim3 dimBlock(32,32,1);
+    dim3 GS3d0 = dim3(ceil(n0/32.0), ceil(nproj / 32.0), nz);
+    dim3 GS3d1 = dim3(ceil(n/32.0), ceil(nproj / 32.0), nz);
+    dim3 GS3d2 = dim3(ceil((n/2+1)/32.0), ceil(nproj / 32.0), nz);
+    padedge <<<GS3d1, dimBlock, 0, stream>>> (gpad, g, n, n0, nproj, nz);
+    cufftXtExec(plan_filter_fwd, gpad, ge, CUFFT_FORWARD);
+    mulw <<<GS3d2, dimBlock, 0, stream>>> (ge, w, n/2+1, nproj, nz);
+    cufftXtExec(plan_filter_inv, ge, gpad, CUFFT_INVERSE);
+    mulcrop <<<GS3d0, dimBlock, 0, stream>>> (g, gpad, 1/(float)n, n, n0, nproj, nz);
+}
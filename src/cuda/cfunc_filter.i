@@ -18,4 +18,5 @@ public:
   cfunc_filter(size_t nproj, size_t nz, size_t n);
   ~cfunc_filter();
   void filter(size_t g, size_t w, size_t stream);
+  void filter_pad(size_t g, size_t w, size_t n0, size_t stream);
 };
@@ -12,6 +12,7 @@ class cfunc_filter {
   cufftHandle plan_filter_fwd;
   cufftHandle plan_filter_inv;
   real2* ge;
+  real* gpad = NULL; // padded projections for filter_pad, allocated on first use
 
 public:
   size_t n;      // width of square slices
@@ -20,6 +21,7 @@ public:
   cfunc_filter(size_t nproj, size_t nz, size_t n);
   ~cfunc_filter();
   void filter(size_t g, size_t w, size_t stream);
+  void filter_pad(size_t g, size_t w, size_t n0, size_t stream);
   void free();
 };
 
@@ -27,3 +27,25 @@ void __global__ mulrec(real *f, float c, int n, int nproj, int nz)
   int f_ind = tx + ty * n + tz * n * nproj;
   f[f_ind] = static_cast<real>((float)f[f_ind] * c);
 }
+
+void __global__ padedge(real *fpad, real *f, int n, int n0, int nproj, int nz)
+{
+  int tx = blockDim.x * blockIdx.x + threadIdx.x;
+  int ty = blockDim.y * blockIdx.y + threadIdx.y;
+  int tz = blockDim.z * blockIdx.z + threadIdx.z;
+  if (tx >= n || ty >= nproj || tz >= nz)
+    return;
+  int x = min(max(tx - (n/2 - n0/2), 0), n0 - 1);
+  fpad[tx + ty * n + tz * n * nproj] = f[x + ty * n0 + tz * n0 * nproj];
+}
+
+void __global__ mulcrop(real *f, real *fpad, float c, int n, int n0, int nproj, int nz)
+{
+  int tx = blockDim.x * blockIdx.x + threadIdx.x;
+  int ty = blockDim.y * blockIdx.y + threadIdx.y;
+  int tz = blockDim.z * blockIdx.z + threadIdx.z;
+  if (tx >= n0 || ty >= nproj || tz >= nz)
+    return;
+  int fpad_ind = tx + (n/2 - n0/2) + ty * n + tz * n * nproj;
+  f[tx + ty * n0 + tz * n0 * nproj] = static_cast<real>((float)fpad[fpad_ind] * c);
+}
@@ -44,11 +44,11 @@ import configparser
 import logging
 import warnings
 import inspect
-import h5py
-import numpy as np
+import functools
 
 from copy import copy
 from pathlib import Path
+from types import MappingProxyType
 from collections import OrderedDict
 
 from tomocupy import utils
@@ -61,6 +61,12 @@ __docformat__ = 'restructuredtext en'
 log = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _cached_signature(func):
+    """Signature of *func*, built once per callable."""
+    return inspect.signature(func)
+
+
 def default_parameter(func, param):
     """Get the default value for a function parameter.
 
@@ -81,7 +87,7 @@ def default_parameter(func, param):
     """
     # Retrieve the function parameter by introspection
     try:
-        sig = inspect.signature(func)
+        sig = _cached_signature(func)
         _param = sig.parameters[param]
     except TypeError as e:
         warnings.warn(str(e))
@@ -283,6 +289,11 @@ SECTIONS['lamino'] = {
         'default': -1,
         'type': int,
         'help': "End slice for lamino reconstruction"},
+    'lamino-transport-dtype': {
+        'default': 'complex64',
+        'type': str,
+        'help': "Data type for keeping 2D Fourier transforms of projections in cpu memory, bfloat16 halves memory and transfers at the cost of precision",
+        'choices': ['complex64', 'bfloat16']},
 }
 
 SECTIONS['reconstruction-types'] = {
@@ -568,24 +579,87 @@ RECON_PARAMS = ('file-reading', 'remove-stripe',
 RECON_STEPS_PARAMS = ('file-reading', 'remove-stripe', 'reconstruction',
                       'retrieve-phase', 'fw', 'ti', 'vo-all', 'lamino', 'reconstruction-steps-types', 'rotate-proj', 'beam-hardening')
 
-NICE_NAMES = ('General', 'File reading', 'Remove stripe',
-              'Remove stripe FW', 'Remove stripe Titarenko', 'Remove stripe Vo' 'Retrieve phase', 'Reconstruction')
+# section titles for logging, in the order of SECTIONS
+_SECTION_NICE = OrderedDict((
+    ('general', 'General'),
+    ('file-reading', 'File reading'),
+    ('remove-stripe', 'Remove stripe'),
+    ('fw', 'Remove stripe FW'),
+    ('vo-all', 'Remove stripe Vo'),
+    ('ti', 'Remove stripe Titarenko'),
+    ('retrieve-phase', 'Retrieve phase'),
+    ('rotate-proj', 'Rotate projections'),
+    ('lamino', 'Laminography'),
+    ('reconstruction-types', 'Reconstruction types'),
+    ('reconstruction-steps-types', 'Reconstruction steps types'),
+    ('reconstruction', 'Reconstruction'),
+    ('beam-hardening', 'Beam hardening'),
+))
+assert list(_SECTION_NICE) == list(SECTIONS), 'every section needs a title in _SECTION_NICE, in the order of SECTIONS'
+
+# sections are read-only after import, which keeps the lookups below valid,
+# section and option names with dashes are not interned by the compiler as identifier-like literals are
+SECTIONS = OrderedDict(
+    (sys.intern(section), MappingProxyType({sys.intern(name): opts for name, opts in section_opts.items()}))
+    for section, section_opts in SECTIONS.items())
+_SECTION_ITEMS = {section: tuple(section_opts.items())
+                  for section, section_opts in SECTIONS.items()}
+
+# option lookups precomputed once: (name, python name, action, nargs, default as written
+# to config files) per option, extra keys cannot go to SECTIONS since options are passed to argparse
+_SECTIONS_FLAT = {section: tuple((name, sys.intern(name.replace('-', '_')), opts.get('action'), opts.get('nargs'),
+                                  str(opts['default']) if opts['default'] is not None else '')
+                                 for name, opts in _SECTION_ITEMS[section])
+                  for section in SECTIONS}
+
+
+def _make_emitter(name, action, nargs):
+    """Function converting a config file value of the option to command line arguments."""
+    if action == 'store_true':
+        # Only the key is on the command line for this action
+        flag = ['--{}'.format(name)]
+        return lambda value: flag if value == 'True' else []
+    if nargs == '+':
+        return lambda value: ['--{}'.format(name)] + [v.strip() for v in value.split(',')]
+    return lambda value: ['--{}={}'.format(name, value)]
+
+
+# command line emitters per option used when reading config files, keyed by
+# the lowercase name as options are stored in config files
+_EMITTERS = {section: tuple((name.lower(), _make_emitter(name, action, nargs))
+                            for name, _, action, nargs, _ in _SECTIONS_FLAT[section])
+             for section in SECTIONS}
+# option names per section in the order they are added to parsers
+_SORTED_SECTION_KEYS = {section: sorted(section_opts)
+                        for section, section_opts in SECTIONS.items()}
+
+
+def _config_line(name, value):
+    """Config file line for the option, formatted as configparser writes it."""
+    prefix = '# ' if value == '' else ''
+    value = str(value).replace('\n', '\n\t')
+    return f'{prefix}{name.lower()} = {value}'
+
+
+# config file lines with default values per section
+_DEFAULT_CONFIG_LINES = {section: tuple(_config_line(name, default)
+                                        for name, _, _, _, default in _SECTIONS_FLAT[section] if name != 'config')
+                         for section in SECTIONS}
+# argument names per section in the order they are logged
+_SORTED_SECTION_ARGS = {section: tuple(sorted(sys.intern(name.replace('-', '_')) for name in section_opts))
+                        for section, section_opts in SECTIONS.items()}
 
 
 def get_config_name():
     """Get the command line --config option."""
-    name = CONFIG_FILE_NAME
-    for i, arg in enumerate(sys.argv):
-        if arg.startswith('--config'):
-            if arg == '--config':
-                return sys.argv[i + 1]
-            else:
-                name = sys.argv[i].split('--config')[1]
-                if name[0] == '=':
-                    name = name[1:]
-                return name
+    argv = iter(sys.argv[1:])
+    for arg in argv:
+        if arg == '--config':
+            return next(argv, CONFIG_FILE_NAME)
+        if arg.startswith('--config='):
+            return arg[9:]
 
-    return name
+    return CONFIG_FILE_NAME
 
 
 def parse_known_args(parser, subparser=False):
@@ -604,6 +678,15 @@ def parse_known_args(parser, subparser=False):
     return parser.parse_known_args(values)[0]
 
 
+@functools.lru_cache(maxsize=4)
+def _load_config(config_name, mtime, size):
+    """Parsed config file, *mtime* and *size* only invalidate the cache when the file changes."""
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read([config_name]):
+        return None
+    return config
+
+
 def config_to_list(config_name=CONFIG_FILE_NAME):
     """
     Read arguments from config file and convert them to a list of keys and
@@ -611,28 +694,24 @@ def config_to_list(config_name=CONFIG_FILE_NAME):
     *config_name* is the file name of the config file.
     """
     result = []
-    config = configparser.ConfigParser()
-
-    if not config.read([config_name]):
+    try:
+        st = Path(config_name).stat()
+    except OSError:
+        return []
+    config = _load_config(str(config_name), st.st_mtime_ns, st.st_size)
+    if config is None:
         return []
 
-    for section in SECTIONS:
-        for name, opts in ((n, o) for n, o in SECTIONS[section].items() if config.has_option(section, n)):
-            value = config.get(section, name)
-
-            if value != '' and value != 'None':
-                action = opts.get('action', None)
-
-                if action == 'store_true' and value == 'True':
-                    # Only the key is on the command line for this action
-                    result.append('--{}'.format(name))
+    extend = result.extend
+    for section, section_emitters in _EMITTERS.items():
+        if not config.has_section(section):
+            continue
+        section_values = config[section]
+        for key, emit in section_emitters:
+            value = section_values.get(key)
 
-                if not action == 'store_true':
-                    if opts.get('nargs', None) == '+':
-                        result.append('--{}'.format(name))
-                        result.extend((v.strip() for v in value.split(',')))
-                    else:
-                        result.append('--{}={}'.format(name, value))
+            if value is not None and value != '' and value != 'None':
+                extend(emit(value))
 
     return result
 
@@ -643,7 +722,7 @@ class Params(object):
 
     def add_parser_args(self, parser):
         for section in self.sections:
-            for name in sorted(SECTIONS[section]):
+            for name in _SORTED_SECTION_KEYS[section]:
                 opts = SECTIONS[section][name]
                 parser.add_argument('--{}'.format(name), **opts)
 
@@ -652,10 +731,16 @@ class Params(object):
         return parser
 
     def get_defaults(self):
-        parser = argparse.ArgumentParser()
-        self.add_arguments(parser)
-
-        return parser.parse_args('')
+        # defaults are taken from SECTIONS directly without building a parser,
+        # string defaults are converted by the option type as argparse does
+        defaults = {}
+        for section in self.sections:
+            for name, opts in _SECTION_ITEMS[section]:
+                value = opts['default']
+                if isinstance(value, str) and 'type' in opts:
+                    value = opts['type'](value)
+                defaults[name.replace('-', '_')] = value
+        return argparse.Namespace(**defaults)
 
 
 def write(config_file, args=None, sections=None):
@@ -664,26 +749,29 @@ def write(config_file, args=None, sections=None):
     otherwise use the defaults. If *sections* are specified, write values from
     *args* only to those sections, use the defaults on the remaining ones.
     """
-    config = configparser.ConfigParser()
-
-    for section in SECTIONS:
-        config.add_section(section)
-        for name, opts in SECTIONS[section].items():
-            if args and sections and section in sections and hasattr(args, name.replace('-', '_')):
-                value = getattr(args, name.replace('-', '_'))
-
-                if isinstance(value, list):
-                    value = ', '.join(value)
-            else:
-                value = opts['default'] if opts['default'] is not None else ''
-
-            prefix = '# ' if value == '' else ''
-
-            if name != 'config':
-                config.set(section, prefix + name, str(value))
+    lines = []
+    append = lines.append
+    for section, section_opts in _SECTIONS_FLAT.items():
+        append(f'[{section}]')
+        if not (args and sections and section in sections):
+            # without args for the section only defaults are written
+            lines.extend(_DEFAULT_CONFIG_LINES[section])
+        else:
+            for name, pyname, _, _, default in section_opts:
+                if hasattr(args, pyname):
+                    value = getattr(args, pyname)
+
+                    if isinstance(value, list):
+                        value = ', '.join(value)
+                else:
+                    value = default
+
+                if name != 'config':
+                    append(_config_line(name, value))
+        append('')
 
     with open(config_file, 'w') as f:
-        config.write(f)
+        f.write('\n'.join(lines) + '\n')
 
 
 def show_config(args):
@@ -694,9 +782,8 @@ def show_config(args):
     args = args.__dict__
 
     log.warning('tomocupy status start')
-    for section, name in zip(SECTIONS, NICE_NAMES):
-        entries = sorted(
-            (k for k in args.keys() if k.replace('_', '-') in SECTIONS[section]))
+    for section, name in _SECTION_NICE.items():
+        entries = [k for k in _SORTED_SECTION_ARGS[section] if k in args]
         if entries:
             for entry in entries:
                 value = args[entry] if args[entry] != None else "-"
@@ -713,9 +800,8 @@ def log_values(args):
     args = args.__dict__
 
     log.warning('tomocupyon status start')
-    for section, name in zip(SECTIONS, NICE_NAMES):
-        entries = sorted(
-            (k for k in args.keys() if k.replace('_', '-') in SECTIONS[section]))
+    for section, name in _SECTION_NICE.items():
+        entries = [k for k in _SORTED_SECTION_ARGS[section] if k in args]
 
         # print('log_values', section, name, entries)
         if entries:
@@ -739,42 +825,47 @@ def update_hdf_process(fname, args=None, sections=None):
     if they are specified, otherwise use the defaults. If *sections* are specified, 
     write values from *args* only to those sections, use the defaults on the remaining ones.
     """
+    import h5py
+
     if (args == None):
         log.warning("  *** Not saving log data to the HDF file.")
 
     else:
+        # collect values of all options first, then write them section by section
+        records = []
+        append = records.append
+        for section, section_opts in _SECTIONS_FLAT.items():
+            from_args = sections and section in sections
+            for name, pyname, _, _, default in section_opts:
+                if from_args and hasattr(args, pyname):
+                    value = getattr(args, pyname)
+                    if isinstance(value, list):
+                        value = ', '.join(value)
+                else:
+                    value = default
+
+                if name != 'config':
+                    append((section, name, str(value)))
+
+        prefix_root = f'/process/tomocupy-{__version__}'
         with h5py.File(fname, 'r+') as hdf_file:
             # If the group we will write to already exists, remove it
-            if hdf_file.get('/process/tomocupy-' + __version__):
-                del (hdf_file['/process/tomocupy-' + __version__])
-            # dt = h5py.string_dtype(encoding='ascii')
+            if hdf_file.get(prefix_root):
+                del (hdf_file[prefix_root])
             log.info("  *** tomopy.conf parameter written to /process%s in file %s " %
                      (__version__, fname))
-            config = configparser.ConfigParser()
-            for section in SECTIONS:
-                config.add_section(section)
-                for name, opts in SECTIONS[section].items():
-                    if args and sections and section in sections and hasattr(args, name.replace('-', '_')):
-                        value = getattr(args, name.replace('-', '_'))
-                        if isinstance(value, list):
-                            # print(type(value), value)
-                            value = ', '.join(value)
-                    else:
-                        value = opts['default'] if opts['default'] is not None else ''
-
-                    prefix = '# ' if value == '' else ''
-
-                    if name != 'config':
-                        dataset = '/process' + '/tomocupy-' + \
-                            __version__ + '/' + section + '/' + name
-                        dset_length = len(str(value)) * \
-                            2 if len(str(value)) > 5 else 10
-                        dt = 'S{0:d}'.format(dset_length)
-                        hdf_file.require_dataset(dataset, shape=(1,), dtype=dt)
-                        log.info(name + ': ' + str(value))
-                        try:
-                            hdf_file[dataset][0] = np.string_(str(value))
-                        except TypeError:
-                            log.error(
-                                "Could not convert value {}".format(value))
-                            raise
+            groups = {}
+            for section, name, value in records:
+                if section not in groups:
+                    groups[section] = hdf_file.require_group(f'{prefix_root}/{section}')
+                dset_length = len(value)*2 if len(value) > 5 else 10
+                dt = 'S{0:d}'.format(dset_length)
+                log.info(name + ': ' + value)
+                try:
+                    # dataset is created together with its value in one call
+                    groups[section].create_dataset(
+                        name, shape=(1,), dtype=dt, data=[value.encode('ascii', 'replace')])
+                except TypeError:
+                    log.error(
+                        "Could not convert value {}".format(value))
+                    raise
@@ -47,6 +47,51 @@ from beamhardening import beamhardening as bh
 
 log = logging.getLogger(__name__)
 
+_FILTER_RE = re.compile(r'(?P<material>[A-Za-z_]+)_(?P<thickness>[0-9.]+)(?P<unit>[a-z]*)')
+# tomoScan attenuator groups and the matching (material, thickness, auto, density) params for filters 1-3
+_FILTER_PATHS = tuple(f'/measurement/instrument/attenuator_{i}' for i in (1, 2, 3))
+_PARAM_NAMES = tuple((f'filter_{i}_material', f'filter_{i}_thickness', f'filter_{i}_auto', f'filter_{i}_density')
+                     for i in (1, 2, 3))
+
+
+# in-place linear interpolation on increasing knots xp with values fp, same as cp.interp:
+# clamped to the end values outside the knots, NaN passes through
+_centerline_kernel = cp.ElementwiseKernel(
+    'raw float32 xp, raw float32 fp, int32 n',
+    'T x',
+    '''
+    float v = (float)x;
+    if (!isnan(v)) {
+        float r;
+        if (v <= xp[0]) {
+            r = fp[0];
+        } else if (v >= xp[n-1]) {
+            r = fp[n-1];
+        } else {
+            // binary search for xp[lo] <= v < xp[hi]
+            int lo = 0, hi = n-1;
+            while (hi-lo > 1) {
+                int mid = (lo+hi)/2;
+                if (xp[mid] <= v) lo = mid; else hi = mid;
+            }
+            r = fp[lo]+(fp[hi]-fp[lo])/(xp[hi]-xp[lo])*(v-xp[lo]);
+        }
+        x = (T)r;
+    }
+    ''',
+    'centerline_inplace')
+
+
+@cp.fuse()
+def _median_diff(median_flat, median_dark):
+    return median_flat.astype('float32') - median_dark.astype('float32')
+
+
+@cp.fuse()
+def _apply_row_correction(data, correction):
+    data *= correction
+
+
 class Beam_Corrector():
     def __init__(self, params):
         print(params)
@@ -56,7 +101,15 @@ class Beam_Corrector():
         with h5py.File(params.file_name,'r') as fid:
             flat = fid['/exchange/data_white'][:] 
             dark = fid['/exchange/data_dark'][:] 
-        median_flat = np.median(flat, axis=0) - np.median(dark, axis=0)
+        # upload in the detector dtype (typically uint16) asynchronously
+        # while the beam hardening model is set up on CPU
+        upload_stream = cp.cuda.Stream(non_blocking=True)
+        flat_gpu = cp.empty(flat.shape, dtype=flat.dtype)
+        dark_gpu = cp.empty(dark.shape, dtype=dark.dtype)
+        flat_p = utils.pinned_array(flat)  # keep pinned buffers alive until the copy is done
+        dark_p = utils.pinned_array(dark)
+        flat_gpu.set(flat_p, stream=upload_stream)
+        dark_gpu.set(dark_p, stream=upload_stream)
         self.beam_corr= bh.BeamCorrector(calculate_source = params.calculate_source,
                                         e_storage_ring = params.e_storage_ring,
                                         b_storage_ring = params.b_storage_ring,
@@ -74,65 +127,84 @@ class Beam_Corrector():
                             params.sample_material,
                             params.sample_density,
                             )
-        self.beam_corr.add_filter(
-                            params.filter_1_material,
-                            params.filter_1_thickness,
-                            params.filter_1_density,
-                            )
-        self.beam_corr.add_filter(
-                            params.filter_2_material,
-                            params.filter_2_thickness,
-                            params.filter_2_density,
-                            )
-        self.beam_corr.add_filter(
-                            params.filter_3_material,
-                            params.filter_3_thickness,
-                            params.filter_3_density,
+        for material_name, thickness_name, _, density_name in _PARAM_NAMES:
+            # zero thickness means an open filter position, nothing to add
+            thickness = getattr(params, thickness_name)
+            if thickness > 0:
+                self.beam_corr.add_filter(
+                            getattr(params, material_name),
+                            thickness,
+                            getattr(params, density_name),
                             )
         self.beam_corr.set_geometry(
                             params.source_distance,
                             params.pixel_size,
                             )
+        upload_stream.synchronize()
+        median_flat = _median_diff(cp.median(flat_gpu, axis=0),
+                                   cp.median(dark_gpu, axis=0)).get()
         self.beam_corr.find_angles(median_flat)
 
         #Put the linear interpolation values in params
         self.beam_corr.compute_interp_values()
-        self.interp_angles = cp.array(self.beam_corr.angular_interp_values[0])
-        self.interp_corrector = cp.array(self.beam_corr.angular_interp_values[1])
-        self.interp_trans = cp.array(self.beam_corr.centerline_interp_values[0])
-        self.interp_pathlength = cp.array(self.beam_corr.centerline_interp_values[1])
+        self.interp_angles = cp.asarray(self.beam_corr.angular_interp_values[0], dtype=cp.float32)
+        self.interp_corrector = cp.asarray(self.beam_corr.angular_interp_values[1], dtype=cp.float32)
+        self.interp_trans = cp.asarray(self.beam_corr.centerline_interp_values[0], dtype=cp.float32)
+        self.interp_pathlength = cp.asarray(self.beam_corr.centerline_interp_values[1], dtype=cp.float32)
+
+        # The angle of each detector row is fixed for the scan, precompute the row correction factors
+        all_angles = cp.asarray(self.beam_corr.angles, dtype=cp.float32)
+        self.row_correction = cp.interp(all_angles, self.interp_angles, self.interp_corrector).astype(cp.float32)
         self.params = params
 
     def parse_meta(self, params):
-        params = self.read_pixel_size(params)
-        params = self.read_filter_materials(params)
-        params = self.read_scintillator(params)
-        params = utils.read_bright_ratio(params)
+        # Open the file once and share the handle between all meta data readers
+        with h5py.File(params.file_name, 'r') as fid:
+            self.meta_items = self._list_meta_items(fid)
+            params = self.read_pixel_size(params, fid)
+            params = self.read_filter_materials(params, fid)
+            params = self.read_scintillator(params, fid)
+            params = utils.read_bright_ratio(params, fid)
         return params
 
+    def _list_meta_items(self, fid):
+        '''Collect the paths of all items under /measurement with a single tree walk,
+        so existence checks while parsing meta data are plain set lookups.
+        '''
+        items = set()
+        if '/measurement' in fid:
+            fid['/measurement'].visit(lambda name: items.add('/measurement/' + name))
+        return items
+
+    def _has_meta_item(self, fid, path):
+        '''Check if *path* exists in the file. visit() lists every object under one
+        hard link name only and skips soft and external links, so a miss in the
+        collected paths is checked in the file.
+        '''
+        return path in self.meta_items or path in fid
+
     def correct_centerline(self, data):
-        data[:] = cp.interp(data, self.interp_trans, self.interp_pathlength)
+        _centerline_kernel(self.interp_trans, self.interp_pathlength,
+                           np.int32(self.interp_trans.size), data)
         return data
 
     def correct_angle(self, data, current_rows):
-        angles = cp.array(self.beam_corr.angles[current_rows])
-        correction = cp.interp(angles, self.interp_angles, self.interp_corrector)
-        for i in range(correction.shape[0]):
-            data[:,i,:] = data[:,i,:] * correction[i]
+        correction = self.row_correction[current_rows].astype(data.dtype, copy=False)
+        _apply_row_correction(data, correction[cp.newaxis, :, cp.newaxis])
         return data
 
-    def read_filter_materials(self, params):
+    def read_filter_materials(self, params, fid):
         '''Read the beam filter configuration.
         This discriminates between files created with tomoScan and
         the previous meta data format.
         '''
-        if utils.check_item_exists_hdf(params.file_name, '/measurement/instrument/attenuator_1'):
-            return self.read_filter_materials_tomoscan(params)
+        if self._has_meta_item(fid, '/measurement/instrument/attenuator_1'):
+            return self.read_filter_materials_tomoscan(params, fid)
         else:
-            return self.read_filter_materials_old(params)
+            return self.read_filter_materials_old(params, fid)
 
 
-    def read_filter_materials_tomoscan(self, params):
+    def read_filter_materials_tomoscan(self, params, fid):
         '''Read the beam filter configuration from the HDF file.
         
         If params.filter_{n}_auto for n in [1,2,3] is True,
@@ -156,34 +228,32 @@ class Beam_Corrector():
         '''
         log.info('  *** auto reading filter configuration')
         # Read the relevant data from disk
-        filter_path = '/measurement/instrument/attenuator_{idx}'
-        param_path = 'filter_{idx}_{attr}'
-        for idx_filter in range(1,4,1):
-            if not utils.check_item_exists_hdf(params.file_name, filter_path.format(idx = idx_filter)):
+        for idx_filter in (1, 2, 3):
+            filter_path = _FILTER_PATHS[idx_filter-1]
+            material_name, thickness_name, auto_name, _ = _PARAM_NAMES[idx_filter-1]
+            if not self._has_meta_item(fid, filter_path):
                 log.warning('  *** *** Filter {idx} not found in HDF file.  Set this filter to none'
                                         .format(idx = idx_filter))
-                setattr(params, param_path.format(idx=idx_filter, attr='material'), 'Al')
-                setattr(params, param_path.format(idx=idx_filter, attr='thickness'), 0.0)
+                setattr(params, material_name, 'Al')
+                setattr(params, thickness_name, 0.0)
                 continue
-            filter_auto = getattr(params, param_path.format(idx=idx_filter, attr='auto'))
+            filter_auto = getattr(params, auto_name)
             if filter_auto != 'True' and filter_auto != True:
                 log.warning('  *** *** do not auto read filter {n}'.format(n=idx_filter))
                 continue
             log.warning('  *** *** auto reading parameters for filter {0}'.format(idx_filter))
+            filter_grp = fid[filter_path]
             # See if there are description and thickness fields
-            if utils.check_item_exists_hdf(params.file_name, filter_path.format(idx = idx_filter) + '/description'):
-                filt_material = utils.param_from_dxchange(params.file_name,
-                                            filter_path.format(idx=idx_filter) + '/description',
+            if self._has_meta_item(fid, filter_grp.name + '/description'):
+                filt_material = utils.param_from_dxchange(filter_grp, 'description',
                                             char_array = True, scalar = False)
-                filt_thickness = int(utils.param_from_dxchange(params.file_name,
-                                            filter_path.format(idx=idx_filter) + '/thickness',
+                filt_thickness = int(utils.param_from_dxchange(filter_grp, 'thickness',
                                             char_array = False, scalar = True))
             else:
                 #The filter info is just the raw string from the filter unit.
                 log.warning('  *** *** filter {idx} info must be read from the raw string'
                                 .format(idx = idx_filter))
-                filter_str = utils.param_from_dxchange(params.file_name,
-                                            filter_path.format(idx=idx_filter) + '/setup/filter_unit_text',
+                filter_str = utils.param_from_dxchange(filter_grp, 'setup/filter_unit_text',
                                             char_array = True, scalar = False)
                 if filter_str is None:
                     log.warning('  *** *** Could not load filter %d configuration from HDF5 file.' % idx_filter)
@@ -192,13 +262,13 @@ class Beam_Corrector():
                     filt_material, filt_thickness = self._filter_str_to_params(filter_str)
 
             # Update the params with the loaded values
-            setattr(params, param_path.format(idx=idx_filter, attr='material'), filt_material)
-            setattr(params, param_path.format(idx=idx_filter, attr='thickness'), filt_thickness)
+            setattr(params, material_name, filt_material)
+            setattr(params, thickness_name, filt_thickness)
             log.info('  *** *** Filter %d: (%s %f)' % (idx_filter, filt_material, filt_thickness))
         return params
 
 
-    def read_filter_materials_old(self, params):
+    def read_filter_materials_old(self, params, fid):
         '''Read the beam filter configuration from the HDF file.
         
         If params.filter_1_material and/or params.filter_2_material are
@@ -230,7 +300,7 @@ class Beam_Corrector():
             filter_param = getattr(params, param_path.format(idx=idx_filter, attr='material'))
             if filter_param == 'auto':
                 # Read recorded filter condition from the HDF5 file
-                filter_str = utils.param_from_dxchange(params.file_name,
+                filter_str = utils.param_from_dxchange(fid,
                                                         filter_path.format(idx=idx_filter),
                                                         char_array=True, scalar=False)
                 if filter_str is None:
@@ -253,8 +323,7 @@ class Beam_Corrector():
             material, thickness = open_filter
         else:
             # Parse the filter string to get the parameters
-            filter_re = '(?P<material>[A-Za-z_]+)_(?P<thickness>[0-9.]+)(?P<unit>[a-z]*)'
-            match = re.match(filter_re, filter_str)
+            match = _FILTER_RE.match(filter_str)
             if match:
                 material, thickness, unit = match.groups()
             else:
@@ -263,21 +332,20 @@ class Beam_Corrector():
                 unit = 'um'
             # Convert strings into numbers
             thickness = float(thickness)
-            factors = {
-                'nm': 1e-3,
-                'um': 1,
-                'mm': 1e3,
-            }
-            try:
-                factor = factors[unit]
-            except KeyError:
+            if unit == 'um':
+                factor = 1
+            elif unit == 'mm':
+                factor = 1e3
+            elif unit == 'nm':
+                factor = 1e-3
+            else:
                 log.warning('  *** *** Cannot interpret filter unit in "%s"' % filter_str)
                 factor = 1
             thickness *= factor
         return material, thickness
 
 
-    def read_pixel_size(self, params):
+    def read_pixel_size(self, params, fid):
         '''
         Read the pixel size and magnification from the HDF file.
         Use to compute the effective pixel size.
@@ -287,33 +355,31 @@ class Beam_Corrector():
             log.info('  *** *** OFF')
             return params
 
-        if utils.check_item_exists_hdf(params.file_name,
-                                    '/measurement/instrument/detection_system/objective/resolution'):
-            params.pixel_size = utils.param_from_dxchange(params.file_name,
+        if self._has_meta_item(fid, '/measurement/instrument/detection_system/objective/resolution'):
+            params.pixel_size = utils.param_from_dxchange(fid,
                                                 '/measurement/instrument/detection_system/objective/resolution')
             log.info('  *** *** effective pixel size = {:6.4e} microns'.format(params.pixel_size))
             return(params)
         log.warning('  *** tomoScan resolution parameter not found.  Try old format')
-        pixel_size = utils.param_from_dxchange(params.file_name,
+        pixel_size = utils.param_from_dxchange(fid,
                                                 '/measurement/instrument/detector/pixel_size_x')
-        mag = utils.param_from_dxchange(params.file_name,
+        mag = utils.param_from_dxchange(fid,
                                         '/measurement/instrument/detection_system/objective/magnification')
         #Handle case where something wasn't read right
         if not (pixel_size and mag):
             log.warning('  *** *** problem reading pixel size from the HDF file')
             return params
         #What if pixel size isn't in microns, but in mm or m?
-        for i in range(3):
-            if pixel_size < 0.5:
-                pixel_size *= 1e3
-            else:
-                break
+        if pixel_size < 5e-4:
+            pixel_size *= 1e6
+        elif pixel_size < 0.5:
+            pixel_size *= 1e3
         params.pixel_size = pixel_size / mag
         log.info('  *** *** effective pixel size = {:6.4e} microns'.format(params.pixel_size))
         return params
 
 
-    def read_scintillator(self, params):
+    def read_scintillator(self, params, fid):
         '''Read the scintillator type and thickness from the HDF file.
         '''
         if params.read_scintillator:
@@ -321,8 +387,8 @@ class Beam_Corrector():
             possible_names = ['/measurement/instrument/detection_system/scintillator/scintillating_thickness',
                             '/measurement/instrument/detection_system/scintillator/active_thickness']
             for pn in possible_names:
-                if utils.check_item_exists_hdf(params.file_name, pn):
-                    val = utils.param_from_dxchange(params.file_name,
+                if self._has_meta_item(fid, pn):
+                    val = utils.param_from_dxchange(fid,
                                              pn, attr=None,
                                              scalar=True,
                                              char_array=False)
@@ -334,8 +400,8 @@ class Beam_Corrector():
                             '/measurement/instrument/detection_system/scintillator/description']
             scint_material_string = ''
             for pn in possible_names:
-                if utils.check_item_exists_hdf(params.file_name, pn):
-                    scint_material_string = utils.param_from_dxchange(params.file_name,
+                if self._has_meta_item(fid, pn):
+                    scint_material_string = utils.param_from_dxchange(fid,
                                                 pn, scalar = False, char_array = True)
                     break
             else:
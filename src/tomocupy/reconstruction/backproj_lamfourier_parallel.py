@@ -43,12 +43,55 @@ from tomocupy import logging
 from tomocupy.reconstruction import fbp_filter
 from tomocupy.reconstruction import lamfourierrec
 from tomocupy.global_vars import args, params
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 import cupy as cp
+import cupyx
 import numpy as np
 
 log = logging.getLogger(__name__)
 
+# ndarray.get blocks the host by default since CuPy 13, copies to cpu are
+# synchronized with events instead
+_GET_ASYNC = {'blocking': False} if int(cp.__version__.split('.')[0]) >= 13 else {}
+
+# filter multiplied by the phase factor shifting the rotation center, one row per projection
+_shift_filter_kernel = cp.ElementwiseKernel(
+    'raw float32 wfilter, raw float32 sht, float32 center, int32 n2, int32 ne',
+    'complex64 w',
+    '''
+    int nw = ne/2+1;
+    int x = i % nw;
+    float s, c;
+    sincosf(-2*3.141592653589793f*x/ne*(-center+sht[i / nw]+n2/2.0f), &s, &c);
+    w = complex<float>(wfilter[x]*c, wfilter[x]*s);
+    ''',
+    'shift_filter')
+
+# complex64 to a pair of bfloat16 (real in low, imag in high bits) with rounding to nearest even
+_pack_bf16_kernel = cp.ElementwiseKernel(
+    'complex64 x',
+    'uint32 y',
+    '''
+    unsigned int re = __float_as_uint(x.real());
+    unsigned int im = __float_as_uint(x.imag());
+    re += 0x7fff + ((re >> 16) & 1);
+    im += 0x7fff + ((im >> 16) & 1);
+    y = (re >> 16) | (im & 0xffff0000u);
+    ''',
+    'pack_bf16')
+
+# pair of bfloat16 back to complex64
+_unpack_bf16_kernel = cp.ElementwiseKernel(
+    'uint32 y',
+    'complex64 x',
+    'x = complex<float>(__uint_as_float(y << 16), __uint_as_float(y & 0xffff0000u));',
+    'unpack_bf16')
+
+
+def _chunk_plan(n, nc):
+    """Slices and sizes of chunks of length nc covering range(n)"""
+    return [(slice(st, min(n, st+nc)), min(n, st+nc)-st) for st in range(0, n, nc)]
+
 
 class BackprojLamFourierParallel():
     """Fourier-based method for laminography reconstruction with chunk data processing (https://arxiv.org/abs/2401.11101)    
@@ -66,12 +109,19 @@ class BackprojLamFourierParallel():
         self.dethc = params.ncz
         self.center = params.center
         self.ne = 4*self.detw
+        self.theta = cp.asarray(params.theta, dtype='float32')
+
+        # chunk slices for the processing loops
+        self._plan_usfft1d = _chunk_plan(self.n1, self.n1c)
+        self._plan_fft2d = _chunk_plan(self.ntheta, self.nthetac)
+        # slices in the flipped part are also needed for handling r2c FFT
+        self._plan_usfft2d = [(sl, s, slice(self.deth-sl.stop+1, self.deth-sl.start+1))
+                              for sl, s in _chunk_plan(self.deth//2+1, self.dethc)]
 
         self.cl_lamfourier = lamfourierrec.LamFourierRec(
             self.n0, self.n1, self.n2, self.ntheta, self.detw, self.deth, self.n1c, self.nthetac, self.dethc)
 
         ################################
-        s3 = [self.ntheta, self.deth, self.detw]
         s2 = [self.ntheta, self.deth, (self.detw//2+1)]
         s1 = [self.n1, (self.deth//2+1), self.n2]
         s0 = [self.n1, self.n0, self.n2]
@@ -83,26 +133,28 @@ class BackprojLamFourierParallel():
         s1c = [self.n1c, self.deth//2+1, self.n2]
         s0c = [self.n1c, self.n0, self.n2]
 
-        # blocks to reuse memory
-        global_block_size = max(np.prod(s0), np.prod(
-            s1)*2, np.prod(s2)*2, np.prod(s3))
+        # 2D Fourier transforms of projections are optionally kept as bfloat16 pairs
+        self.transport_bf16 = args.lamino_transport_dtype == 'bfloat16'
+        s2_size = np.prod(s2) if self.transport_bf16 else np.prod(s2)*2
+
+        # blocks to reuse memory, pab0 holds pa11 and pab1 holds pa22 and pa00
         gpu_block_size = max(np.prod(s0c), np.prod(
             s1c)*2, np.prod(s2c)*2, np.prod(s3c)*2, np.prod(s4c)*2, np.prod(s5c))
 
-        self.pab0 = np.empty(global_block_size, dtype='float32')
-        self.pab1 = np.empty(global_block_size, dtype='float32')
+        self.pab0 = np.empty(np.prod(s1)*2, dtype='float32')
+        self.pab1 = np.empty(max(np.prod(s0), s2_size), dtype='float32')
 
-        self.pa33 = self.pab0[:np.prod(s3)].reshape(s3)
-        self.pa22 = self.pab1[:np.prod(s2)*2].view('complex64').reshape(s2)
+        if self.transport_bf16:
+            self.pa22 = self.pab1[:np.prod(s2)].view('uint32').reshape(s2)
+        else:
+            self.pa22 = self.pab1[:np.prod(s2)*2].view('complex64').reshape(s2)
         self.pa11 = self.pab0[:np.prod(s1)*2].view('complex64').reshape(s1)
         self.pa00 = self.pab1[:np.prod(s0)].reshape(s0)
 
         self.gab0 = cp.empty(2*gpu_block_size, dtype='float32')
         self.gab1 = cp.empty(2*gpu_block_size, dtype='float32')
-        self.gpab0 = utils.pinned_array(
-            np.empty(gpu_block_size, dtype='float32'))
-        self.gpab1 = utils.pinned_array(
-            np.empty(gpu_block_size, dtype='float32'))
+        self.gpab0 = cupyx.empty_pinned(gpu_block_size, dtype='float32')
+        self.gpab1 = cupyx.empty_pinned(gpu_block_size, dtype='float32')
 
         self.ga55 = self.gab0[:2*np.prod(s5c)].reshape(2, *s5c)
         self.ga44 = self.gab1[:2 *
@@ -122,10 +174,27 @@ class BackprojLamFourierParallel():
         self.gpa11 = self.gpab0[:np.prod(s1c)*2].view('complex64').reshape(s1c)
         self.gpa00 = self.gpab1[:np.prod(s0c)].reshape(s0c)
 
+        if self.transport_bf16:
+            # packed gpu buffers and pinned staging for the bfloat16 path
+            self.gk44 = cp.empty([2, *s4c], dtype='uint32')
+            self.gk33 = cp.empty([2, *s3c], dtype='uint32')
+            self.gpa44 = self.gpab1[:np.prod(s4c)].view('uint32').reshape(s4c)
+            self.gpa33 = self.gpab0[:np.prod(s3c)].view('uint32').reshape(s3c)
+        else:
+            self.gk44 = None
+            self.gk33 = None
+
         # streams for overlapping data transfers with computations
         self.stream1 = cp.cuda.Stream(non_blocking=False)
         self.stream2 = cp.cuda.Stream(non_blocking=False)
         self.stream3 = cp.cuda.Stream(non_blocking=False)
+        # events ordering transfers and computations on double buffers between streams,
+        # the host waits only when it needs to reuse a pinned buffer
+        self.evt_h2d = [cp.cuda.Event(disable_timing=True) for _ in range(2)]
+        self.evt_compute = [cp.cuda.Event(disable_timing=True) for _ in range(2)]
+        self.evt_d2h = [cp.cuda.Event(disable_timing=True) for _ in range(2)]
+        # single host-side join at the end of each processing loop
+        self.evt_join = cp.cuda.Event(disable_timing=True)
 
         # threads for data writing to disk
         self.write_threads = []
@@ -136,162 +205,219 @@ class BackprojLamFourierParallel():
             self.ne, self.deth, self.nthetac, args.dtype)  # note filter is applied on projections, not sinograms as in other methods
 
         self.wfilter = self.cl_filter.calc_filter(args.fbp_filter)
+        # no additional center shift for projections in a chunk
+        self.zero_sht = cp.zeros([self.nthetac, 1], dtype='float32')
+        # filter with the center fix for zero shifts is the same for all chunks
+        self.wfilter_shifted = cp.empty([self.nthetac, self.ne//2+1], dtype='complex64')
+        _shift_filter_kernel(self.wfilter, self.zero_sht, cp.float32(
+            self.center), self.n2, self.ne, self.wfilter_shifted)
 
         self.cl_writer = cl_writer
+        # persistent threads for writing reconstructed chunks in parallel
+        self.write_pool = ThreadPoolExecutor(
+            args.max_write_threads, thread_name_prefix='write')
 
         self.rec_fun = self.rec_lam
 
+    def __del__(self):
+        # __init__ may fail before the pool is created
+        if hasattr(self, 'write_pool'):
+            self.write_pool.shutdown(wait=False)
+
     def usfft1d_chunks(self, out_t, inp_t, out_gpu, inp_gpu, out_p, inp_p, phi):
         log.info("usfft1d by chunks.")
-        nchunk = int(np.ceil(self.n1/self.n1c))
+        plan = self._plan_usfft1d
+        nchunk = len(plan)
 
+        # double buffer slots: k0 for chunks k and k-2, k1 for chunk k-1, swapped every iteration
+        k0, k1 = 0, 1
         for k in range(nchunk+2):
             utils.printProgressBar(
                 k, nchunk+1, nchunk-k+1, length=40)
             if (k > 0 and k < nchunk+1):
+                # wait for the input chunk and for the output buffer to be copied out
+                self.stream2.wait_event(self.evt_h2d[k1])
+                self.stream2.wait_event(self.evt_d2h[k1])
                 with self.stream2:  # gpu computations
                     self.cl_lamfourier.usfft1d_adj(
-                        out_gpu[(k-1) % 2], inp_gpu[(k-1) % 2], phi, self.stream2)
+                        out_gpu[k1], inp_gpu[k1], phi, self.stream2)
+                self.evt_compute[k1].record(self.stream2)
             if (k > 1):
-                with self.stream3:  # gpu->cpu pinned copy
-                    # contiguous copy, fast  # not swapaxes
-                    out_gpu[(k-2) % 2].get(out=out_p)
+                self.stream3.wait_event(self.evt_compute[k0])
+                # gpu->cpu pinned copy, contiguous copy, fast  # not swapaxes
+                out_gpu[k0].get(out=out_p, stream=self.stream3, **_GET_ASYNC)
+                self.evt_d2h[k0].record(self.stream3)
 
             if (k < nchunk):
-                st, end = k*self.n1c, min(self.n1, (k+1)*self.n1c)
-                s = end-st
-                # inp_p[:s] = inp_t[st:end]
-                utils.copy(inp_t[st:end], inp_p)
-                with self.stream1:
-                    inp_gpu[k % 2].set(inp_p)
-
-            self.stream3.synchronize()
+                sl, s = plan[k]
+                # the pinned buffer is free once the previous chunk is on gpu
+                self.evt_h2d[k1].synchronize()
+                # inp_p[:s] = inp_t[sl]
+                utils.copy(inp_t[sl], inp_p)
+                # the gpu buffer is free once the computation on chunk k-2 is done
+                self.stream1.wait_event(self.evt_compute[k0])
+                inp_gpu[k0].set(inp_p, stream=self.stream1)
+                self.evt_h2d[k0].record(self.stream1)
 
             if (k > 1):
+                self.evt_d2h[k0].synchronize()
                 # cpu pinned->cpu copy
-                st, end = (k-2)*self.n1c, min(self.n1, (k-1)*self.n1c)
-                s = end-st
-                # out_t[st:end] = out_p[:s]
-                utils.copy(out_p[:s], out_t[st:end])
+                sl, s = plan[k-2]
+                # out_t[sl] = out_p[:s]
+                utils.copy(out_p[:s], out_t[sl])
+
+            k0, k1 = k1, k0
 
-            self.stream1.synchronize()
-            self.stream2.synchronize()
+        # the last copy to cpu on stream3 follows all transfers and computations
+        self.evt_join.record(self.stream3)
+        self.evt_join.synchronize()
 
-    def usfft2d_chunks(self, out, inp, out_gpu, inp_gpu, out_p, inp_p, theta, phi):
+    def usfft2d_chunks(self, out, inp, out_gpu, inp_gpu, out_p, inp_p, theta, phi, inp_pk=None):
+        """inp_pk is a gpu buffer receiving bfloat16 packed input, None for complex64 input"""
         log.info("usfft2d by chunks.")
+        inp_dst = inp_gpu if inp_pk is None else inp_pk
 
-        theta = cp.array(theta)
-        nchunk = int(np.ceil((self.deth//2+1)/self.dethc))
+        plan = self._plan_usfft2d
+        nchunk = len(plan)
+        # double buffer slots: k0 for chunks k and k-2, k1 for chunk k-1, swapped every iteration
+        k0, k1 = 0, 1
         for k in range(nchunk+2):
             utils.printProgressBar(
                 k, nchunk+1, nchunk-k+1, length=40)
             if (k > 0 and k < nchunk+1):
+                # wait for the input chunk and for the output buffer to be copied out
+                self.stream2.wait_event(self.evt_h2d[k1])
+                self.stream2.wait_event(self.evt_d2h[k1])
                 with self.stream2:  # gpu computations
+                    if inp_pk is not None:
+                        _unpack_bf16_kernel(inp_pk[k1], inp_gpu[k1])
                     self.cl_lamfourier.usfft2d_adj(
-                        out_gpu[(k-1) % 2], inp_gpu[(k-1) % 2], theta, phi, k-1, self.stream2)
+                        out_gpu[k1], inp_gpu[k1], theta, phi, k-1, self.stream2)
+                self.evt_compute[k1].record(self.stream2)
             if (k > 1):
-                with self.stream3:  # gpu->cpu copy
-                    out_gpu[(k-2) % 2].get(out=out_p)
+                self.stream3.wait_event(self.evt_compute[k0])
+                # gpu->cpu copy
+                out_gpu[k0].get(out=out_p, stream=self.stream3, **_GET_ASYNC)
+                self.evt_d2h[k0].record(self.stream3)
 
             if (k < nchunk):
                 # cpu -> cpu pinned copy
-                st, end = k*self.dethc, min(self.deth//2+1, (k+1)*self.dethc)
-                s = end-st
-                utils.copy(inp[:, st:end], inp_p[:self.ntheta, :s])
+                sl, s, sl_flip = plan[k]
+                # the pinned buffer is free once the previous chunk is on gpu
+                self.evt_h2d[k1].synchronize()
+                utils.copy(inp[:, sl], inp_p[:self.ntheta, :s])
                 # copy the flipped part of the array for handling r2c FFT
                 if k == 0:
-                    utils.copy(inp[:, self.deth-end+1:self.deth -
-                               st+1], inp_p[self.ntheta:, -s:-1])
+                    utils.copy(inp[:, sl_flip], inp_p[self.ntheta:, -s:-1])
                     utils.copy(inp[:, 0], inp_p[self.ntheta:, -1])
                 else:
-                    utils.copy(inp[:, self.deth-end+1:self.deth -
-                               st+1], inp_p[self.ntheta:, -s:])
+                    utils.copy(inp[:, sl_flip], inp_p[self.ntheta:, -s:])
 
-                with self.stream1:  # cpu pinned->gpu copy
-                    inp_gpu[k % 2].set(inp_p)
+                # cpu pinned->gpu copy once the computation on chunk k-2 is done
+                self.stream1.wait_event(self.evt_compute[k0])
+                inp_dst[k0].set(inp_p, stream=self.stream1)
+                self.evt_h2d[k0].record(self.stream1)
 
-            self.stream3.synchronize()
             if (k > 1):
+                self.evt_d2h[k0].synchronize()
                 # cpu pinned->cpu copy
-                st, end = (k-2)*self.dethc, min(self.deth //
-                                                2+1, (k-1)*self.dethc)
-                s = end-st
-                utils.copy(out_p[:, :s], out[:, st:end])
+                sl, s, _ = plan[k-2]
+                utils.copy(out_p[:, :s], out[:, sl])
 
-            self.stream1.synchronize()
-            self.stream2.synchronize()
+            k0, k1 = k1, k0
 
-    def fft2_chunks(self, out, inp, out_gpu, inp_gpu, out_p, inp_p):
+        # the last copy to cpu on stream3 follows all transfers and computations
+        self.evt_join.record(self.stream3)
+        self.evt_join.synchronize()
+
+    def fft2_chunks(self, out, inp, out_gpu, inp_gpu, out_p, inp_p, out_pk=None):
+        """out_pk is a gpu buffer for packing the output to bfloat16, None for complex64 output"""
         log.info("fft2 by chunks.")
+        out_src = out_gpu if out_pk is None else out_pk
 
-        nchunk = int(np.ceil(self.ntheta/self.nthetac))
+        plan = self._plan_fft2d
+        nchunk = len(plan)
+        # double buffer slots: k0 for chunks k and k-2, k1 for chunk k-1, swapped every iteration
+        k0, k1 = 0, 1
         for k in range(nchunk+2):
             utils.printProgressBar(
                 k, nchunk+1, nchunk-k+1, length=40)
             if (k > 0 and k < nchunk+1):
+                # wait for the input chunk and for the output buffer to be copied out
+                self.stream2.wait_event(self.evt_h2d[k1])
+                self.stream2.wait_event(self.evt_d2h[k1])
                 with self.stream2:  # gpu computations
-                    data0 = inp_gpu[(k-1) % 2]
-                    data0 = self.fbp_filter_center(
-                        data0, cp.tile(np.float32(0), [data0.shape[0], 1]))
+                    data0 = inp_gpu[k1]
+                    data0 = self.fbp_filter_center(data0)
                     self.cl_lamfourier.fft2d_fwd(
-                        out_gpu[(k-1) % 2], data0, self.stream2)
+                        out_gpu[k1], data0, self.stream2)
+                    if out_pk is not None:
+                        _pack_bf16_kernel(out_gpu[k1], out_pk[k1])
+                self.evt_compute[k1].record(self.stream2)
             if (k > 1):
-                with self.stream3:  # gpu->cpu pinned copy
-                    out_gpu[(k-2) % 2].get(out=out_p)
+                self.stream3.wait_event(self.evt_compute[k0])
+                # gpu->cpu pinned copy
+                out_src[k0].get(out=out_p, stream=self.stream3, **_GET_ASYNC)
+                self.evt_d2h[k0].record(self.stream3)
 
             if (k < nchunk):
-                with self.stream1:  # cpu->gpu copy
-                    st, end = k * \
-                        self.nthetac, min(self.ntheta, (k+1)*self.nthetac)
-                    s = end-st
-                    utils.copy(inp[st:end], inp_p[:s])
-                    inp_gpu[k % 2].set(inp_p)
-
-            self.stream3.synchronize()
+                sl, s = plan[k]
+                # the pinned buffer is free once the previous chunk is on gpu
+                self.evt_h2d[k1].synchronize()
+                utils.copy(inp[sl], inp_p[:s])
+                # cpu->gpu copy once the computation on chunk k-2 is done
+                self.stream1.wait_event(self.evt_compute[k0])
+                inp_gpu[k0].set(inp_p, stream=self.stream1)
+                self.evt_h2d[k0].record(self.stream1)
+
             if (k > 1):
+                self.evt_d2h[k0].synchronize()
                 # cpu pinned ->cpu copy
-                st, end = (k-2)*self.nthetac, min(self.ntheta,
-                                                  (k-1)*self.nthetac)
-                s = end-st
-                utils.copy(out_p[:s], out[st:end])
-            self.stream1.synchronize()
-            self.stream2.synchronize()
-
-    def fbp_filter_center(self, data, sht=0):
-        """FBP filtering of projections with applying the rotation center shift wrt to the origin"""
-
-        tmp = cp.pad(
-            data, ((0, 0), (0, 0), (self.ne//2-self.n2//2, self.ne//2-self.n2//2)), mode='edge')
-        t = cp.fft.rfftfreq(self.ne).astype('float32')
-        w = self.wfilter*cp.exp(-2*cp.pi*1j*t*(-self.center +
-                                               sht[:, cp.newaxis]+self.n2/2))  # center fix
-        self.cl_filter.filter(tmp, w, cp.cuda.get_current_stream())
-        data[:] = tmp[:, :, self.ne//2-self.n2//2:self.ne//2+self.n2//2]
+                sl, s = plan[k-2]
+                utils.copy(out_p[:s], out[sl])
+
+            k0, k1 = k1, k0
+
+        # the last copy to cpu on stream3 follows all transfers and computations
+        self.evt_join.record(self.stream3)
+        self.evt_join.synchronize()
+
+    def fbp_filter_center(self, data, sht=None):
+        """FBP filtering of projections with applying the rotation center shift wrt to the origin,
+        sht=None corresponds to zero shifts and uses the precomputed filter"""
+
+        if sht is None:
+            w = self.wfilter_shifted[:data.shape[0]]
+        else:
+            w = cp.empty([data.shape[0], self.ne//2+1], dtype='complex64')
+            _shift_filter_kernel(self.wfilter, sht, cp.float32(self.center), self.n2, self.ne, w)
+        # padding to ne is done inside the filter, the result is written to data
+        self.cl_filter.filter_pad(data, w, cp.cuda.get_current_stream())
 
         return data  # reuse input memory
 
     def rec_lam(self, data):
         """Reconstruction via the the Fourier-based method"""
 
-        utils.copy(data, self.pa33)
-        self.fft2_chunks(self.pa22, self.pa33, self.ga44,
-                         self.ga55, self.gpa44, self.gpa55)
+        # fft2_chunks reads projections chunk by chunk into pinned memory,
+        # so the input is used directly without staging it in a host buffer
+        self.fft2_chunks(self.pa22, data, self.ga44,
+                         self.ga55, self.gpa44, self.gpa55, self.gk44)
         self.usfft2d_chunks(self.pa11, self.pa22, self.ga22, self.ga33, self.gpa22,
-                            self.gpa33, params.theta, np.pi/2+params.lamino_angle/180*np.pi)
+                            self.gpa33, self.theta, np.pi/2+params.lamino_angle/180*np.pi, self.gk33)
         self.usfft1d_chunks(self.pa00, self.pa11, self.ga00, self.ga11,
                             self.gpa00, self.gpa11, np.pi/2+params.lamino_angle/180*np.pi)
         u = utils.copyTransposed(self.pa00)
         self.write_parallel(u)
 
     def write_parallel(self, u, nthreads=16):
-        nchunk = int(np.ceil(u.shape[0]/nthreads))
-        mthreads = []
-        for k in range(nthreads):
-            st = k*nchunk+params.lamino_start_row
-            end = min((k+1)*nchunk, u.shape[0])+params.lamino_start_row
-            th = Thread(target=self.cl_writer.write_data_chunk, args=(
-                u[k*nchunk:min((k+1)*nchunk, u.shape[0])], st, end, k))
-            mthreads.append(th)
-            th.start()
-        for th in mthreads:
-            th.join()
+        nchunk = max(1, int(np.ceil(u.shape[0]/nthreads)))
+        futures = []
+        # chunks are not empty, writers may not handle zero slices
+        for k, (sl, _) in enumerate(_chunk_plan(u.shape[0], nchunk)):
+            st = sl.start+params.lamino_start_row
+            end = sl.stop+params.lamino_start_row
+            futures.append(self.write_pool.submit(self.cl_writer.write_data_chunk,
+                                                  u[sl], st, end, k))
+        for f in futures:
+            f.result()
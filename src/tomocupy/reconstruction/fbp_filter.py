@@ -54,9 +54,14 @@ class FBPFilter():
     def filter(self, data, w, stream):
         # reorganize data as a complex array, reuse data
         data = cp.ascontiguousarray(data)
-        w = cp.ascontiguousarray(w.view('float32').astype(data.dtype))
+        w = cp.ascontiguousarray(w.view('float32').astype(data.dtype, copy=False))
         self.fslv.filter(data.data.ptr, w.data.ptr, stream.ptr)
 
+    def filter_pad(self, data, w, stream):
+        # data of width <= n is padded with edge values inside the filter and processed in-place
+        w = cp.ascontiguousarray(w.view('float32').astype(data.dtype, copy=False))
+        self.fslv.filter_pad(data.data.ptr, w.data.ptr, data.shape[-1], stream.ptr)
+
     def calc_filter(self, filter):
         d = 0.5
         t = cp.arange(0, self.n/2+1)/self.n
@@ -44,6 +44,7 @@ import h5py
 import cupy as cp
 import argparse
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 import time
 import numexpr as ne
 import sys
@@ -157,20 +158,21 @@ def downsample(data, binning):
     return data
 
 
+# persistent workers for multithreaded memory copies (numpy releases the GIL while copying),
+# avoids creating new threads on every call
+_copy_pool = ThreadPoolExecutor(16, thread_name_prefix='copy')
+
+
 def _copy(res, u, st, end):
     res[st:end] = u[st:end]
 
 
 def copy(u, res, nthreads=16):
     nchunk = int(np.ceil(u.shape[0]/nthreads))
-    mthreads = []
-    for k in range(nthreads):
-        th = Thread(target=_copy, args=(
-            res, u, k*nchunk, min((k+1)*nchunk, u.shape[0])))
-        mthreads.append(th)
-        th.start()
-    for th in mthreads:
-        th.join()
+    futures = [_copy_pool.submit(_copy, res, u, k*nchunk, min((k+1)*nchunk, u.shape[0]))
+               for k in range(nthreads)]
+    for f in futures:
+        f.result()
     return res
 
 
@@ -182,27 +184,26 @@ def copyTransposed(u, res=[], nthreads=16):
     if res == []:
         res = np.empty([u.shape[1], u.shape[0], u.shape[2]], dtype=u.dtype)
     nchunk = int(np.ceil(u.shape[1]/nthreads))
-    mthreads = []
-    for k in range(nthreads):
-        th = Thread(target=_copyTransposed, args=(
-            res, u, k*nchunk, min((k+1)*nchunk, u.shape[1])))
-        mthreads.append(th)
-        th.start()
-    for th in mthreads:
-        th.join()
+    futures = [_copy_pool.submit(_copyTransposed, res, u, k*nchunk, min((k+1)*nchunk, u.shape[1]))
+               for k in range(nthreads)]
+    for f in futures:
+        f.result()
     return res
 
 
-def read_bright_ratio(params):
+def read_bright_ratio(params, hdf_file=None):
     '''Read the ratio between the bright exposure and other exposures.
+    *hdf_file* is an optional open h5py.File to read from instead of params.file_name.
     '''
+    if hdf_file is None:
+        hdf_file = params.file_name
     log.info('  *** *** Find bright exposure ratio params from the HDF file')
     try:
         possible_names = ['/measurement/instrument/detector/different_flat_exposure',
                           '/process/acquisition/flat_fields/different_flat_exposure']
         for pn in possible_names:
-            if check_item_exists_hdf(params.file_name, pn):
-                diff_bright_exp = param_from_dxchange(params.file_name, pn,
+            if check_item_exists_hdf(hdf_file, pn):
+                diff_bright_exp = param_from_dxchange(hdf_file, pn,
                                                       attr=None, scalar=False, char_array=True)
                 break
         if diff_bright_exp.lower() == 'same':
@@ -213,12 +214,12 @@ def read_bright_ratio(params):
                           '/process/acquisition/flat_fields/flat_exposure_time',
                           '/measurement/instrument/detector/brightfield_exposure_time']
         for pn in possible_names:
-            if check_item_exists_hdf(params.file_name, pn):
-                bright_exp = param_from_dxchange(params.file_name, pn,
+            if check_item_exists_hdf(hdf_file, pn):
+                bright_exp = param_from_dxchange(hdf_file, pn,
                                                  attr=None, scalar=True, char_array=False)
                 break
         log.info('  *** *** %f' % bright_exp)
-        norm_exp = param_from_dxchange(params.file_name,
+        norm_exp = param_from_dxchange(hdf_file,
                                        '/measurement/instrument/detector/exposure_time',
                                        attr=None, scalar=True, char_array=False)
         log.info('  *** *** %f' % norm_exp)
@@ -231,37 +232,49 @@ def read_bright_ratio(params):
     return params
 
 
-def check_item_exists_hdf(hdf_filename, item_name):
+def check_item_exists_hdf(hdf_file, item_name):
     '''Checks if an item exists in an HDF file.
     Inputs
-    hdf_filename: str filename or pathlib.Path object for HDF file to check
+    hdf_file: str filename, pathlib.Path object or an open h5py.File for HDF file to check
     item_name: name of item whose existence needs to be checked
     '''
-    with h5py.File(hdf_filename, 'r') as hdf_file:
+    if isinstance(hdf_file, h5py.Group):
         return item_name in hdf_file
+    with h5py.File(hdf_file, 'r') as f:
+        return item_name in f
 
 
 def param_from_dxchange(hdf_file, data_path, attr=None, scalar=True, char_array=False):
     """
     Reads a parameter from the HDF file.
     Inputs
-    hdf_file: string path or pathlib.Path object for the HDF file.
+    hdf_file: string path, pathlib.Path object or an open h5py.File for the HDF file.
     data_path: path to the requested data in the HDF file.
     attr: name of the attribute if this is stored as an attribute (default: None)
     scalar: True if the value is a single valued dataset (dafault: True)
     char_array: if True, interpret as a character array.  Useful for EPICS strings (default: False)
     """
+    if isinstance(hdf_file, h5py.Group):
+        return _param_from_hdf(hdf_file, data_path, attr, scalar, char_array)
     if not Path(hdf_file).is_file():
         return None
     with h5py.File(hdf_file, 'r') as f:
-        try:
-            if attr:
-                return f[data_path].attrs[attr].decode('ASCII')
-            elif char_array:
-                return ''.join([chr(i) for i in f[data_path][0]]).strip(chr(0))
-            elif scalar:
-                return f[data_path][0]
-            else:
-                return None
-        except KeyError:
+        return _param_from_hdf(f, data_path, attr, scalar, char_array)
+
+
+def _param_from_hdf(f, data_path, attr, scalar, char_array):
+    try:
+        if attr:
+            return f[data_path].attrs[attr].decode('ASCII')
+        elif char_array:
+            value = f[data_path][0]
+            # fixed-length strings are read as bytes, numeric char arrays are converted
+            if not isinstance(value, bytes):
+                value = np.asarray(value, dtype=np.uint8).tobytes()
+            return value.strip(b'\x00').decode('latin-1')
+        elif scalar:
+            return f[data_path][0]
+        else:
             return None
+    except KeyError:
+        return None
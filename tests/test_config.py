@@ -0,0 +1,27 @@
+import unittest
+import os
+import tempfile
+
+from tomocupy import config
+
+
+class Tests(unittest.TestCase):
+    def config_to_list(self, text):
+        with tempfile.TemporaryDirectory() as tmp:
+            config_name = os.path.join(tmp, 'tomocupy.conf')
+            with open(config_name, 'w') as f:
+                f.write(text)
+            return config.config_to_list(config_name)
+
+    def test_indented_options(self):
+        values = self.config_to_list(
+            '[general]\n  verbose = True\n  logs-home = /x\n')
+        self.assertEqual(sorted(values), ['--logs-home=/x', '--verbose'])
+
+    def test_section_header_comment(self):
+        values = self.config_to_list('[general] ; c\nverbose = True\n')
+        self.assertEqual(values, ['--verbose'])
+
+
+if __name__ == '__main__':
+    unittest.main()